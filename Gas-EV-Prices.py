@@ -1,14 +1,21 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.html as LH
 import pandas as pd
 import json
+import orjson
+import hashlib
 from datetime import datetime
 import time
+import random
 import re
 import os
 
 # 1. Configuration
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')  # Changed to use environment variable
+# Set VERBOSE=1 to print column lists and DataFrame previews
+VERBOSE = bool(os.environ.get('VERBOSE'))
 GIST_ID = 'e003b91ea818923bcc97dc33b711a0e1'
 TARGET_URLS = {
     'gas_prices': 'https://gasprices.aaa.com/todays-state-averages/',
@@ -21,10 +28,138 @@ HEADERS = {
     'Accept-Language': 'en-US,en;q=0.9',
 }
 
-def make_respectful_request(url):
+# Characters stripped from price cells before converting them to numbers
+PRICE_CLEANUP_RE = re.compile(r'[$,\s]')
+
+# Cache of ETag/Last-Modified validators and parsed tables from previous runs
+CACHE_DIR = '.scrape_cache'
+HTTP_CACHE_FILE = os.path.join(CACHE_DIR, 'http_cache.json')
+GIST_HASH_FILE = os.path.join(CACHE_DIR, 'gist_hash.json')
+
+# Shared session so both AAA requests (and the Gist upload) reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# The adapter only retries failed connections, where nothing reached the server.
+# read=False makes urllib3 re-raise read errors as-is, so requests surfaces ReadTimeout
+# and make_respectful_request retries it (and 429/5xx) while respecting the crawl delay.
+RETRY = Retry(total=3, connect=3, read=False, status=0, backoff_factor=1.0)
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=4, pool_block=False, max_retries=RETRY))
+
+# (connect, read) timeouts so a hung server cannot stall the cron job
+REQUEST_TIMEOUT = (3.05, 15)
+
+# robots.txt asks for 10 seconds between requests to the same host
+CRAWL_DELAY = 10
+# Responses worth retrying, and how many retries each AAA request gets
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+_last_request_time = None
+
+def wait_for_crawl_delay():
+    """Sleeps only for whatever is left of the crawl delay since the last request."""
+    if _last_request_time is None:
+        return
+    remaining = CRAWL_DELAY - (time.monotonic() - _last_request_time)
+    if remaining > 0:
+        print(f"Respecting 'Crawl-delay: {CRAWL_DELAY}' from robots.txt ({remaining:.1f}s remaining)...")
+        time.sleep(remaining)
+
+def retry_backoff(attempt, response=None):
+    """Sleeps before a retry: the crawl delay doubled per attempt, with jitter, or longer if Retry-After asks."""
+    delay = CRAWL_DELAY * 2 ** attempt * random.uniform(1.0, 1.5)
+    # Honor a Retry-After given in seconds when it asks for more
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    print(f"  Retrying in {delay:.1f}s...")
+    time.sleep(delay)
+
+def load_http_cache():
+    """Loads the validator cache written by previous runs (empty if missing or unreadable)."""
+    try:
+        with open(HTTP_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def table_cache_path(url):
+    """Returns the pickle path holding the parsed table for a URL."""
+    return os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + '.pkl')
+
+def body_hash(response):
+    """Returns a short hash of the raw response body."""
+    return hashlib.blake2b(response.content, digest_size=16).hexdigest()
+
+def load_cached_table(url, response):
+    """Returns the table parsed on a previous run if the page is unchanged, else None."""
+    if response.status_code != 304:
+        # AAA sometimes changes the ETag without changing the page itself
+        cached = load_http_cache().get(url)
+        if not cached or cached.get('body_hash') != body_hash(response):
+            return None
+    try:
+        df = pd.read_pickle(table_cache_path(url))
+    except Exception as e:
+        # Missing, truncated, or written by an incompatible pandas version
+        print(f"  Warning: could not read cached table: {e}")
+        return None
+    if response.status_code == 304:
+        print("  Page not modified since last run, using cached table.")
+    else:
+        print("  Page content unchanged since last run, using cached table.")
+        # Remember the new validators so the next run can get a 304
+        save_cached_table(url, response, df)
+    return df
+
+def save_cached_table(url, response, df):
+    """Stores the parsed table and the response's validators for the next run."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_pickle(table_cache_path(url))
+        cache = load_http_cache()
+        cache[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body_hash': body_hash(response),
+        }
+        with open(HTTP_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"  Warning: could not write cache: {e}")
+
+def make_respectful_request(url, conditional=True):
     """Makes a GET request with headers and respects robots.txt delay."""
-    print(f"Requesting: {url}")
-    response = requests.get(url, headers=HEADERS)
+    global _last_request_time
+    
+    # Send conditional headers only when we still have the table to fall back on
+    conditional_headers = {}
+    cached = load_http_cache().get(url) if conditional else None
+    if cached and os.path.exists(table_cache_path(url)):
+        if cached.get('etag'):
+            conditional_headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            conditional_headers['If-Modified-Since'] = cached['last_modified']
+    
+    for attempt in range(MAX_RETRIES + 1):
+        wait_for_crawl_delay()
+        print(f"Requesting: {url}")
+        try:
+            response = SESSION.get(url, headers=conditional_headers, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.ReadTimeout, requests.exceptions.ChunkedEncodingError) as e:
+            _last_request_time = time.monotonic()
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"  Read failed ({e.__class__.__name__})")
+            retry_backoff(attempt)
+            continue
+        # The delay is measured from here, so parsing this page overlaps with it
+        _last_request_time = time.monotonic()
+        
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        print(f"  Status: {response.status_code}")
+        retry_backoff(attempt, response)
+    
     response.raise_for_status()  # Check for HTTP errors
     print(f"  Status: {response.status_code}")
     return response
@@ -37,65 +172,35 @@ def update_github_gist(dataframe, token, gist_id):
         print("Error: GITHUB_TOKEN environment variable not set!")
         return None
 
-def extract_table_data(response_text):
-    """Extracts table data directly from HTML response text."""
-    # Use pandas read_html directly on the response text
-    try:
-        # Try to read all tables from the HTML
-        tables = pd.read_html(response_text)
-        if len(tables) == 0:
-            raise ValueError("No tables found in the HTML.")
-        
-        # For AAA website, we want the first table
-        df = tables[0]
-        
-        # Clean column names
-        df.columns = [str(col).strip() for col in df.columns]
-        
-        # Clean state names if 'State' column exists
-        if 'State' in df.columns:
-            df['State'] = df['State'].astype(str).str.strip()
-        elif len(df.columns) > 0:
-            # If first column contains states but has different name
-            df = df.rename(columns={df.columns[0]: 'State'})
-            df['State'] = df['State'].astype(str).str.strip()
-        
-        return df
-    except Exception as e:
-        print(f"Error reading table with pandas: {e}")
-        # Fallback: Parse manually with BeautifulSoup
-        return extract_table_manually(response_text)
-
-def extract_table_manually(html_text):
-    """Manual table extraction as fallback when pandas fails."""
-    print("Using manual table extraction...")
-    soup = BeautifulSoup(html_text, 'html.parser')
-    table = soup.find('table')
+def extract_table_data(html_bytes):
+    """Extracts the first table directly from the raw HTML response body using lxml."""
+    # lxml decodes the bytes itself, honoring the page's declared charset
+    doc = LH.fromstring(html_bytes)
     
-    if not table:
+    # For AAA website, we want the first table
+    rows = doc.xpath('(//table)[1]//tr')
+    if not rows:
         raise ValueError("No table found in HTML")
     
-    # Extract headers
-    headers = []
-    for th in table.find_all('th'):
-        headers.append(th.get_text().strip())
+    # First row holds the headers, the rest are data rows
+    headers = [cell.text_content().strip() for cell in rows[0].xpath('./th|./td')]
+    data = [[cell.text_content().strip() for cell in tr.xpath('./td|./th')] for tr in rows[1:]]
+    data = [row for row in data if row]
     
-    # Extract rows
-    rows = []
-    for tr in table.find_all('tr')[1:]:  # Skip header row
-        cells = tr.find_all(['td', 'th'])
-        if cells:
-            row_data = [cell.get_text().strip() for cell in cells]
-            rows.append(row_data)
+    df = pd.DataFrame(data, columns=headers)
     
-    # Create DataFrame
-    df = pd.DataFrame(rows, columns=headers)
+    # If first column contains states but has different name
+    if 'State' not in df.columns and len(df.columns) > 0:
+        df = df.rename(columns={df.columns[0]: 'State'})
     
-    # Clean numeric columns
-    for col in df.columns:
-        if col != 'State':
-            # Remove $ signs and convert to float
-            df[col] = df[col].str.replace('$', '', regex=False).astype(float)
+    # Clean numeric columns: strip $, commas and spaces from every price cell in one pass,
+    # turning unparseable cells such as "N/A" or "-" into NaN
+    price_cols = [col for col in df.columns if col != 'State']
+    if not price_cols:
+        raise ValueError("No price columns found in table")
+    cells = pd.Series(df[price_cols].to_numpy().ravel())
+    cleaned = pd.to_numeric(cells.str.replace(PRICE_CLEANUP_RE, '', regex=True), errors='coerce')
+    df[price_cols] = cleaned.to_numpy().reshape(len(df), len(price_cols))
     
     return df
 
@@ -104,36 +209,46 @@ def scrape_aaa_gas_prices(url):
     print(f"\n--- Scraping Gas Prices ---")
     
     response = make_respectful_request(url)
+    df = load_cached_table(url, response)
+    if df is not None:
+        return df
+    if response.status_code == 304:
+        # The cached table is unusable and a 304 has no body, so fetch the full page
+        response = make_respectful_request(url, conditional=False)
     
-    # Use the direct HTML response for pandas
-    df = extract_table_data(response.text)
+    # Parse the raw response bytes, no intermediate decoded str
+    df = extract_table_data(response.content)
+    save_cached_table(url, response, df)
     
-    print(f"Found table with columns: {list(df.columns)}")
-    print(f"First few rows:\n{df.head(3)}")
+    if VERBOSE:
+        print(f"Found table with columns: {list(df.columns)}")
+        print(f"First few rows:\n{df.head(3)}")
     return df
 
 def scrape_aaa_ev_prices(url):
     """Scrapes the EV charging price table from the second AAA page."""
     print(f"\n--- Scraping EV Prices ---")
     
-    # RESPECT THE CRAWL DELAY: Wait 10+ seconds before the second request
-    print("Respecting 'Crawl-delay: 10' from robots.txt...")
-    for i in range(10, 0, -1):
-        print(f"  Waiting... {i} seconds remaining.", end='\r')
-        time.sleep(1)
-    print("  Proceeding with request.               ")
-    
+    # The crawl delay is handled in make_respectful_request, counting from the gas request
     response = make_respectful_request(url)
+    df = load_cached_table(url, response)
+    if df is not None:
+        return df
+    if response.status_code == 304:
+        # The cached table is unusable and a 304 has no body, so fetch the full page
+        response = make_respectful_request(url, conditional=False)
     
-    # Use the direct HTML response for pandas
-    df = extract_table_data(response.text)
+    # Parse the raw response bytes, no intermediate decoded str
+    df = extract_table_data(response.content)
     
     # Clean the EV data - ensure proper column names
     if 'Cost/kWh' in df.columns:
         df['Cost/kWh'] = pd.to_numeric(df['Cost/kWh'], errors='coerce')
+    save_cached_table(url, response, df)
     
-    print(f"Found table with columns: {list(df.columns)}")
-    print(f"First few rows:\n{df.head(3)}")
+    if VERBOSE:
+        print(f"Found table with columns: {list(df.columns)}")
+        print(f"First few rows:\n{df.head(3)}")
     return df
 
 def merge_data(gas_df, ev_df):
@@ -144,19 +259,39 @@ def merge_data(gas_df, ev_df):
     
     # Merge the two DataFrames
     merged_df = pd.merge(gas_df, ev_df, on='State', how='left')
+    
+    # Drop rows with no prices at all, they only add noise to the feed
+    # (dropna with an empty subset would drop every row)
+    price_cols = [col for col in merged_df.columns if col != 'State']
+    if price_cols:
+        merged_df = merged_df.dropna(subset=price_cols, how='all')
     return merged_df
 
 def update_github_gist(dataframe, token, gist_id):
     """Updates an existing GitHub Gist with the new data."""
     print(f"\n--- Updating GitHub Gist ---")
     
-    # Convert DataFrame to a Python dictionary (list of records)
-    data_records = dataframe.to_dict(orient='records')
+    # Serialize the records straight from the DataFrame (missing values become null)
+    records_json = dataframe.to_json(orient='records').encode()
+    
+    # Skip the upload when the data (ignoring scrape_date) matches the last upload;
+    # the cached raw_url is still reported so the run needs no API call at all
+    data_hash = hashlib.blake2b(records_json, digest_size=16).hexdigest()
+    try:
+        with open(GIST_HASH_FILE, 'r') as f:
+            last_upload = json.load(f)
+    except (OSError, ValueError):
+        last_upload = {}
+    if (last_upload.get('gist_id') == gist_id and last_upload.get('hash') == data_hash
+            and last_upload.get('raw_url')):
+        print("No changes since the last upload, skipping Gist update.")
+        print(f"Raw JSON URL (for your website): {last_upload['raw_url']}")
+        return last_upload['raw_url']
     
     # Create the final payload structure
     full_data = {
         'scrape_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'data': data_records  # This is now a list of dictionaries, not a JSON string
+        'data': orjson.Fragment(records_json)  # Already-encoded JSON, embedded as-is
     }
     
     # Prepare the API request
@@ -169,14 +304,14 @@ def update_github_gist(dataframe, token, gist_id):
         'description': f'AAA Fuel & EV Price Data - Updated {full_data["scrape_date"]}',
         'files': {
             'aaa_prices.json': {
-                'content': json.dumps(full_data, indent=2)  # Single JSON dump here
+                'content': orjson.dumps(full_data).decode()  # Compact JSON, clients can pretty-print
             }
         }
     }
     
     # Make the PATCH request
     try:
-        response = requests.patch(api_url, headers=headers, json=payload, timeout=30)
+        response = SESSION.patch(api_url, headers=headers, json=payload, timeout=30)
         
         if response.status_code == 200:
             result = response.json()
@@ -186,6 +321,13 @@ def update_github_gist(dataframe, token, gist_id):
             # Extract the correct raw URL from the API response
             raw_url = result['files']['aaa_prices.json']['raw_url']
             print(f"Raw JSON URL (for your website): {raw_url}")
+            
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                with open(GIST_HASH_FILE, 'w') as f:
+                    json.dump({'gist_id': gist_id, 'hash': data_hash, 'raw_url': raw_url}, f)
+            except OSError as e:
+                print(f"Warning: could not write Gist hash: {e}")
             return raw_url
         else:
             print(f"Error from GitHub API: {response.status_code}")
@@ -219,8 +361,9 @@ def main():
         # Merge the data
         merged_df = merge_data(gas_df, ev_df)
         print(f"Merged data: {len(merged_df)} total entries")
-        print(f"\nSample of merged data (first 3 rows):")
-        print(merged_df.head(3).to_string())
+        if VERBOSE:
+            print(f"\nSample of merged data (first 3 rows):")
+            print(merged_df.head(3).to_string())
         
         # Update the GitHub Gist
         raw_url = update_github_gist(merged_df, GITHUB_TOKEN, GIST_ID)
@@ -237,9 +380,9 @@ def main():
   .then(data => {{
     console.log('Last updated:', data.scrape_date);
     console.log('Number of states:', data.data.length);
-    // Access state data: data.data
+    // Access state data: data.data (prices are numbers or null, format them for display)
     data.data.forEach(state => {{
-      console.log(state.State, state.Regular, state['Cost/kWh']);
+      console.log(state.State, state.Regular?.toFixed(3), state['Cost/kWh']);
     }});
   }});""")
         else: